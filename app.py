@@ -1,112 +1,307 @@
 import streamlit as st
 import fitz  # PyMuPDF
 import re
+import hashlib
+import zipfile
+import numpy as np
 import pandas as pd
 from io import BytesIO
 
 # Importações para fuzzy matching
-from fuzzywuzzy import fuzz as fuzzywuzzy_fuzz
 from rapidfuzz import fuzz as rapidfuzz_fuzz
+from rapidfuzz import process as rapidfuzz_process
+from rapidfuzz import utils as rapidfuzz_utils
 
 # --- EXTRAÇÃO DE COMPROVANTES ---
 
+# Padrões pré-compilados (regex não gananciosa), um por campo, na ordem em que são exigidos.
+# Cada campo é buscado separadamente: numa alternação única os matches não se sobrepõem,
+# e o valor de um campo poderia consumir o rótulo de outro.
+_PAT_CAMPOS = (
+    ("data_operacao", re.compile(r"Data da operação:\s*(\d{2}/\d{2}/\d{4})")),
+    ("documento", re.compile(r"Documento:\s*(\d+)")),
+    ("empresa", re.compile(r"Empresa:\s*(.*?)\s*\|")),
+    ("favorecido", re.compile(r"Nome do favorecido:\s*(.*?)\n")),
+    ("valor", re.compile(r"Valor\s*R\$\s*([\d.,]+)")),
+)
+# Remove separador de milhar e troca vírgula decimal em uma única passada
+_VALOR_COMPROVANTE_TABLE = str.maketrans({".": None, ",": "."})
+
+def _parse_page(page_num, text):
+    """
+    Extrai os campos do comprovante a partir do texto de uma página.
+    Retorna (número da página, nome do arquivo, dicionário do resumo) ou None se a página não for um comprovante.
+    """
+    # Primeira ocorrência de cada campo; para na primeira ausência, sem buscar os demais
+    campos = {}
+    for nome, pattern in _PAT_CAMPOS:
+        match = pattern.search(text)
+        if match is None:
+            return None
+        campos[nome] = match.group(1)
+    data_operacao = campos["data_operacao"].strip()
+    numero_documento = campos["documento"].strip()
+    empresa = campos["empresa"].strip()
+    fornecedor = campos["favorecido"].strip()
+    valor_str = campos["valor"].strip().translate(_VALOR_COMPROVANTE_TABLE)
+    try:
+        valor = float(valor_str)
+    except Exception:
+        valor = 0.0
+    file_name = f"{empresa.replace(' ', '_')}_para_{fornecedor.replace(' ', '_')}_{data_operacao.replace('/', '-')}_R${valor:.2f}.pdf"
+    return page_num, file_name, {
+        "Empresa": empresa,
+        "Fornecedor": fornecedor,
+        "Data da Operação": data_operacao,
+        "Valor": valor,
+        "Número do Documento": numero_documento,
+        "Arquivo PDF": file_name
+    }
+
 def extract_transactions(pdf_document):
     """
     Extrai os dados dos comprovantes de cada página do PDF.
     Retorna uma lista de tuplas (número da página, nome do arquivo) e uma lista de dicionários para o resumo.
+    O texto é lido sequencialmente: o PyMuPDF não suporta acesso ao mesmo documento por várias threads.
     """
     transactions = []
     summary_data = []
     for page_num in range(len(pdf_document)):
-        page = pdf_document[page_num]
-        text = page.get_text("text")
-        # Extração individual usando regex não gananciosa
-        data_operacao_match = re.search(r"Data da operação:\s*(\d{2}/\d{2}/\d{4})", text)
-        documento_match = re.search(r"Documento:\s*(\d+)", text)
-        empresa_match = re.search(r"Empresa:\s*(.*?)\s*\|", text)
-        favorecido_match = re.search(r"Nome do favorecido:\s*(.*?)\n", text)
-        valor_match = re.search(r"Valor\s*R\$\s*([\d.,]+)", text)
-        if data_operacao_match and documento_match and empresa_match and favorecido_match and valor_match:
-            data_operacao = data_operacao_match.group(1).strip()
-            numero_documento = documento_match.group(1).strip()
-            empresa = empresa_match.group(1).strip()
-            fornecedor = favorecido_match.group(1).strip()
-            # Remove separador de milhar e troca vírgula decimal
-            valor_str = valor_match.group(1).strip().replace(".", "").replace(",", ".")
-            try:
-                valor = float(valor_str)
-            except Exception:
-                valor = 0.0
-            file_name = f"{empresa.replace(' ', '_')}_para_{fornecedor.replace(' ', '_')}_{data_operacao.replace('/', '-')}_R${valor:.2f}.pdf"
-            transactions.append((page_num, file_name))
-            summary_data.append({
-                "Empresa": empresa,
-                "Fornecedor": fornecedor,
-                "Data da Operação": data_operacao,
-                "Valor": valor,
-                "Número do Documento": numero_documento,
-                "Arquivo PDF": file_name
-            })
+        # Monta o TextPage uma única vez por página, com as flags padrão da extração "text"
+        textpage = pdf_document[page_num].get_textpage(flags=fitz.TEXTFLAGS_TEXT)
+        parsed = _parse_page(page_num, textpage.extractText())
+        if parsed is None:
+            continue
+        page_num, file_name, summary = parsed
+        transactions.append((page_num, file_name))
+        summary_data.append(summary)
     return transactions, summary_data
 
-def save_transaction_pdfs(pdf_document, transactions):
+def _hash_buffer(buffer):
+    """Hash blake2b do conteúdo de um arquivo enviado, usado como chave dos caches."""
+    return hashlib.blake2b(buffer, digest_size=16).digest()
+
+@st.cache_data(show_spinner=False)
+def parse_pdf(file_key, _file_bytes):
+    """
+    Abre o PDF a partir dos bytes enviados e extrai os comprovantes.
+    O cache usa só file_key (hash do arquivo, calculado uma vez pelo chamador), evitando reprocessar
+    o PDF a cada interação; _file_bytes não é hasheado.
+    O documento é fechado ao final para liberar os buffers internos do MuPDF.
+    """
+    with fitz.open(stream=_file_bytes, filetype="pdf") as pdf_document:
+        return extract_transactions(pdf_document)
+
+def _make_single_page_pdf(pdf_bytes, page_num):
     """
-    Salva cada página (comprovante) em um novo PDF mantendo o layout original.
-    Retorna uma lista de tuplas (nome do arquivo, bytes do PDF).
+    Gera um novo PDF contendo apenas a página (comprovante) indicada, mantendo o layout original.
+    Retorna os bytes do PDF. É chamada sob demanda, apenas quando o usuário clica no download.
     """
-    files = []
-    for page_num, file_name in transactions:
-        pdf_writer = fitz.open()
+    with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document, fitz.open() as pdf_writer:
         pdf_writer.insert_pdf(pdf_document, from_page=page_num, to_page=page_num)
-        pdf_bytes = pdf_writer.write()
-        files.append((file_name, pdf_bytes))
-    return files
+        return pdf_writer.write()
+
+# Separadores de caminho e caracteres inválidos em nomes de arquivo
+_NOME_INVALIDO = re.compile(r'[\\/:*?"<>|\x00-\x1f]')
+
+def _zip_entry_name(file_name, used_names):
+    """
+    Nome seguro e único para uma entrada do ZIP.
+    O nome vem do texto do PDF, então separadores de caminho viram "_" e pontos iniciais são removidos
+    (nenhuma entrada cria diretórios ou sai da pasta de extração). Nomes já usados recebem o sufixo
+    _2, _3, ..., verificado também contra os nomes que já têm esse sufixo.
+    """
+    name = _NOME_INVALIDO.sub("_", file_name).lstrip(".") or "comprovante.pdf"
+    if name in used_names:
+        stem = name[:-len(".pdf")]
+        count = 2
+        while f"{stem}_{count}.pdf" in used_names:
+            count += 1
+        name = f"{stem}_{count}.pdf"
+    used_names.add(name)
+    return name
+
+def save_transaction_pdfs_zip(all_transactions):
+    """
+    Gera um ZIP com um PDF por comprovante de todos os arquivos enviados.
+    Cada PDF de origem é aberto uma única vez e suas páginas são copiadas a partir dele.
+    Os nomes das entradas passam por _zip_entry_name, que os torna seguros e únicos.
+    """
+    buffer = BytesIO()
+    used_names = set()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for pdf_bytes, transactions in all_transactions:
+            with fitz.open(stream=pdf_bytes, filetype="pdf") as pdf_document:
+                for page_num, file_name in transactions:
+                    with fitz.open() as pdf_writer:
+                        pdf_writer.insert_pdf(pdf_document, from_page=page_num, to_page=page_num)
+                        zip_file.writestr(_zip_entry_name(file_name, used_names), pdf_writer.write())
+    return buffer.getvalue()
 
 # --- PADRONIZAÇÃO E CONCILIAÇÃO ---
 
+# Remove o prefixo "R$" e espaços e troca vírgula decimal em uma única passada
+_VALOR_CONTA_TABLE = str.maketrans({"R": None, "r": None, "$": None, " ": None, ",": "."})
+
 def standardize_data(df, columns):
-    """Converte as colunas para minúsculas e remove espaços em branco."""
-    for col in columns:
-        df[col] = df[col].astype(str).str.lower().str.strip()
-    return df
+    """Converte as colunas para minúsculas e remove espaços em branco, devolvendo um novo DataFrame."""
+    return df.assign(**{col: df[col].astype(str).str.lower().str.strip() for col in columns})
+
+def to_cents(values):
+    """
+    Converte valores em reais para centavos inteiros (Int64, aceita valores ausentes).
+    Usado como chave de junção: evita a comparação de floats arredondados.
+    """
+    return (values * 100).round().astype("Int64")
+
+@st.cache_data(show_spinner=False)
+def parse_contas(contas_key, _file_bytes):
+    """
+    Lê e padroniza a planilha de contas a pagar a partir dos bytes do CSV enviado.
+    Retorna None se faltar alguma coluna obrigatória.
+    O cache usa só contas_key (hash do arquivo, calculado uma vez pelo chamador), evitando reprocessar
+    a planilha a cada interação; _file_bytes não é hasheado.
+    """
+    df_contas = pd.read_csv(BytesIO(_file_bytes), sep=",", dtype=str)
+    required_cols = ["Empresa", "Fornecedor", "Data Vencimento", "Valor", "Código"]
+    if not all(col in df_contas.columns for col in required_cols):
+        return None
+    df_contas = standardize_data(df_contas, ["Empresa", "Fornecedor"])
+    df_contas["Código"] = df_contas["Código"].astype(str).str.strip()
+    # Valores inválidos viram NaN (sem conciliação) em vez de interromper o app
+    df_contas["Valor"] = pd.to_numeric(df_contas["Valor"].str.translate(_VALOR_CONTA_TABLE), errors="coerce")
+    df_contas["Valor_cents"] = to_cents(df_contas["Valor"])
+    df_contas["Data Vencimento"] = pd.to_datetime(df_contas["Data Vencimento"], dayfirst=True, errors="coerce")
+    return df_contas
 
-def fuzzy_merge(df_contas, df_comprovantes, method="fuzzywuzzy", threshold=90):
+@st.cache_data(show_spinner=False)
+def build_comprovantes(file_keys, _summary_data):
+    """
+    Monta o DataFrame dos comprovantes, sua versão padronizada e o CSV de resumo.
+    O cache usa só file_keys (hashes dos PDFs, na ordem de upload); _summary_data não é hasheado,
+    então mudar o slider ou o método não reconstrói nem padroniza os comprovantes de novo.
+    """
+    df_comprovantes = pd.DataFrame(_summary_data)
+    df_comprovantes_std = standardize_data(df_comprovantes, ["Empresa", "Fornecedor"]).assign(
+        Valor_cents=to_cents(df_comprovantes["Valor"]))
+    csv_comprovantes = df_comprovantes.to_csv(index=False, sep=";").encode()
+    return df_comprovantes, df_comprovantes_std, csv_comprovantes
+
+def share_categories(df_a, df_b, columns):
+    """
+    Converte as colunas dos dois DataFrames para categóricas com as mesmas categorias.
+    Nomes repetidos passam a ocupar um código inteiro, e merges e comparações usam esses códigos.
+    """
+    # Células vazias continuam ausentes (NaN): categorias não podem ser nulas
+    dtypes = {col: pd.CategoricalDtype(pd.concat([df_a[col], df_b[col]]).dropna().unique()) for col in columns}
+    return df_a.astype(dtypes), df_b.astype(dtypes)
+
+@st.cache_data(show_spinner=False)
+def prepare_for_matching(comprovantes_key, contas_key, _df_contas, _df_comprovantes):
+    """
+    Aplica share_categories a Empresa e Fornecedor das contas e dos comprovantes.
+    O cache usa os hashes dos arquivos enviados, como fuzzy_merge, então mudar o slider
+    ou o método não refaz a concatenação e a conversão para categóricas.
+    """
+    return share_categories(_df_contas, _df_comprovantes, ["Empresa", "Fornecedor"])
+
+def _name_codes(contas_names, comp_names):
+    """
+    Fatora os nomes dos dois lados depois de normalizá-los com default_process (como o full_process do fuzzywuzzy).
+    Retorna os códigos das contas, os códigos dos comprovantes, os nomes normalizados e o código de "".
+    Nomes ausentes ou vazios após a normalização recebem o código de "", que tem nota 0 em
+    token_set_ratio contra qualquer nome e fica fora da correspondência exata.
+    """
+    codes, names = pd.factorize(pd.concat([contas_names, comp_names], ignore_index=True))
+    # A normalização roda uma vez por nome distinto; nomes que ficam iguais depois dela passam a ter o mesmo código
+    norm_codes, norm_names = pd.factorize(
+        np.array([rapidfuzz_utils.default_process(name) for name in names] + [""], dtype=object))
+    # A fatoração dá -1 aos ausentes; eles recebem o código do "" acrescentado ao final
+    empty_code = norm_codes[-1]
+    codes = np.where(codes >= 0, norm_codes[codes], empty_code)
+    n_contas = len(contas_names)
+    return codes[:n_contas], codes[n_contas:], norm_names, empty_code
+
+def _unique_cdist(left_codes, right_codes, names, score_cutoff):
+    """
+    Calcula token_set_ratio entre todos os pares de left x right, dados como códigos de names.
+    Nomes repetidos são comuns, então o rapidfuzz só compara os textos distintos de cada lado
+    e a matriz completa é montada por indexação.
+    """
+    left_uniq, left_inv = np.unique(left_codes, return_inverse=True)
+    right_uniq, right_inv = np.unique(right_codes, return_inverse=True)
+    # Os nomes já vêm normalizados por _name_codes, então nenhum processor é aplicado;
+    # float64 mantém as notas idênticas às de token_set_ratio par a par (o padrão do cdist é float32)
+    scores = rapidfuzz_process.cdist(names[left_uniq], names[right_uniq], scorer=rapidfuzz_fuzz.token_set_ratio,
+                                     processor=None, score_cutoff=score_cutoff, dtype=np.float64, workers=-1)
+    return scores[np.ix_(left_inv, right_inv)]
+
+@st.cache_data(show_spinner=False)
+def fuzzy_merge(comprovantes_key, contas_key, _df_contas, _df_comprovantes, threshold=90):
     """
     Realiza a correspondência fuzzy entre a planilha de contas a pagar e os comprovantes.
-    Filtra candidatos com base em Valor_std e compara as colunas Empresa e Fornecedor.
+    Agrupa os dois lados por Valor_cents e, para cada valor em comum, calcula de uma vez
+    as matrizes de similaridade de Empresa e Fornecedor com rapidfuzz.process.cdist.
+    Cada par com média das duas notas >= threshold gera uma linha no resultado.
+    Com threshold 100 o mesmo cálculo é feito (score_cutoff 100), para que subir o limiar
+    nunca descarte pares que já tinham nota 100 em limiares menores.
+    O resultado fica em cache pelas chaves dos arquivos enviados (comprovantes_key, contas_key) e pelo
+    threshold; os DataFrames, derivados desses arquivos, não são hasheados. Assim resolver ambiguidades
+    não refaz a correspondência.
     """
-    matched_rows = []
-    for idx, conta in df_contas.iterrows():
-        candidates = df_comprovantes[df_comprovantes["Valor_std"] == conta["Valor_std"]]
-        if candidates.empty:
-            row = conta.to_dict()
-            row.update({"Número do Documento": None, "Data da Operação": None, "Arquivo PDF": None, "Fuzzy Score": None})
-            matched_rows.append(row)
-        else:
-            found_match = False
-            for j, comp in candidates.iterrows():
-                if method == "fuzzywuzzy":
-                    score_empresa = fuzzywuzzy_fuzz.token_set_ratio(conta["Empresa"], comp["Empresa"])
-                    score_fornecedor = fuzzywuzzy_fuzz.token_set_ratio(conta["Fornecedor"], comp["Fornecedor"])
-                elif method == "rapidfuzz":
-                    score_empresa = rapidfuzz_fuzz.token_set_ratio(conta["Empresa"], comp["Empresa"])
-                    score_fornecedor = rapidfuzz_fuzz.token_set_ratio(conta["Fornecedor"], comp["Fornecedor"])
-                score = (score_empresa + score_fornecedor) / 2
-                if score >= threshold:
-                    found_match = True
-                    row = conta.to_dict()
-                    row.update({
-                        "Número do Documento": comp["Número do Documento"],
-                        "Data da Operação": comp["Data da Operação"],
-                        "Arquivo PDF": comp["Arquivo PDF"],
-                        "Fuzzy Score": score
-                    })
-                    matched_rows.append(row)
-            if not found_match:
-                row = conta.to_dict()
-                row.update({"Número do Documento": None, "Data da Operação": None, "Arquivo PDF": None, "Fuzzy Score": None})
-                matched_rows.append(row)
-    return pd.DataFrame(matched_rows)
+    # Códigos dos nomes normalizados, comuns aos dois lados
+    n_contas = len(_df_contas)
+    contas_emp, comp_emp, emp_names, emp_vazio = _name_codes(_df_contas["Empresa"], _df_comprovantes["Empresa"])
+    contas_forn, comp_forn, forn_names, forn_vazio = _name_codes(_df_contas["Fornecedor"], _df_comprovantes["Fornecedor"])
+    comp_buckets = _df_comprovantes.groupby("Valor_cents", sort=False).indices
+    # A média só alcança o threshold se cada nota for >= 2 * threshold - 100;
+    # abaixo disso o rapidfuzz pode abandonar o cálculo cedo e devolver 0
+    score_cutoff = max(0, 2 * threshold - 100)
+    # Igualdade exata dos nomes normalizados e de Valor_cents vale 100 sem passar pelo rapidfuzz;
+    # contas com algum par exato não entram no cálculo fuzzy. Contas sem Empresa ou Fornecedor ficam de fora
+    contas_keys = pd.DataFrame({"emp": contas_emp, "forn": contas_forn, "valor": _df_contas["Valor_cents"].to_numpy(),
+                                "conta": np.arange(n_contas)})
+    exact = contas_keys[(contas_emp != emp_vazio) & (contas_forn != forn_vazio)].merge(
+        pd.DataFrame({"emp": comp_emp, "forn": comp_forn, "valor": _df_comprovantes["Valor_cents"].to_numpy(),
+                      "comp": np.arange(len(_df_comprovantes))}),
+        on=["emp", "forn", "valor"]
+    )
+    has_exact = np.zeros(n_contas, dtype=bool)
+    has_exact[exact["conta"].to_numpy()] = True
+    # Pares aceitos acumulados em colunas: posição da conta, posição do comprovante e score
+    pair_conta = [exact["conta"].to_numpy()]
+    pair_comp = [exact["comp"].to_numpy()]
+    pair_score = [np.full(len(exact), 100.0)]
+    for valor, conta_pos in _df_contas.groupby("Valor_cents", sort=False).indices.items():
+        comp_pos = comp_buckets.get(valor)
+        conta_pos = conta_pos[~has_exact[conta_pos]]
+        if comp_pos is None or len(conta_pos) == 0:
+            continue
+        score_empresa = _unique_cdist(contas_emp[conta_pos], comp_emp[comp_pos], emp_names, score_cutoff)
+        score_fornecedor = _unique_cdist(contas_forn[conta_pos], comp_forn[comp_pos], forn_names, score_cutoff)
+        scores = (score_empresa + score_fornecedor) / 2
+        i, j = np.nonzero(scores >= threshold)
+        pair_conta.append(conta_pos[i])
+        pair_comp.append(comp_pos[j])
+        pair_score.append(scores[i, j])
+
+    # Contas sem nenhum par entram uma única vez, com comprovante -1 (sem correspondência)
+    matched_contas = np.concatenate(pair_conta)
+    sem_par = np.setdiff1d(np.arange(len(_df_contas)), matched_contas)
+    conta_idx = np.concatenate([matched_contas, sem_par])
+    comp_idx = np.concatenate(pair_comp + [np.full(len(sem_par), -1)])
+    score = np.concatenate(pair_score + [np.full(len(sem_par), np.nan)])
+    # Mantém a ordem das contas e, dentro de cada conta, a ordem dos comprovantes
+    order = np.lexsort((comp_idx, conta_idx))
+
+    df = _df_contas.iloc[conta_idx[order]].reset_index(drop=True)
+    comp_cols = (_df_comprovantes[["Número do Documento", "Data da Operação", "Arquivo PDF"]]
+                 .reset_index(drop=True)
+                 .reindex(comp_idx[order])
+                 .reset_index(drop=True))
+    df = pd.concat([df, comp_cols], axis=1)
+    df["Fuzzy Score"] = score[order]
+    return df
 
 def resolve_ambiguous_receipts(df):
     """
@@ -118,31 +313,30 @@ def resolve_ambiguous_receipts(df):
     Para cada código ambíguo, o usuário escolhe a conta correta para aquele comprovante.
     Para as linhas que não forem escolhidas, "Cod_Comprovante" fica vazia.
     """
-    df = df.copy()
-    # Cria a coluna de possível código a partir do merge
-    df["Possível_Cod_Comprovante"] = df["Número do Documento"]
-    # Inicializa a coluna final igual à possível
-    df["Cod_Comprovante"] = df["Possível_Cod_Comprovante"]
+    # Cria a coluna de possível código a partir do merge e inicializa a coluna final igual a ela
+    df = df.assign(Possível_Cod_Comprovante=df["Número do Documento"], Cod_Comprovante=df["Número do Documento"])
     
     # Identifica códigos ambíguos (não nulos) que aparecem em mais de uma linha
-    ambig_codes = df["Possível_Cod_Comprovante"].dropna().value_counts()
-    ambig_codes = ambig_codes[ambig_codes > 1].index.tolist()
+    possiveis = df["Possível_Cod_Comprovante"]
+    ambig_rows = df[possiveis.duplicated(keep=False) & possiveis.notna()]
     
-    for code in ambig_codes:
-        group = df[df["Possível_Cod_Comprovante"] == code]
+    # Linhas não escolhidas, limpas de uma só vez ao final
+    not_chosen = []
+    # Agrupa uma única vez apenas as linhas ambíguas, na ordem de aparição
+    for code, group in ambig_rows.groupby("Possível_Cod_Comprovante", sort=False):
         st.write(f"Ambiguidade para o comprovante {code}:")
         options = {}
         # Exiba informações úteis para a escolha (por exemplo, Código da conta, Empresa, Fornecedor, Data Vencimento)
-        for idx, row in group.iterrows():
-            option_str = (f"Código da conta: {row['Código']} | Empresa: {row['Empresa'].title()} | "
-                          f"Fornecedor: {row['Fornecedor'].title()} | Data Vencimento: {row['Data Vencimento']}")
+        for idx, codigo, empresa, fornecedor, vencimento in zip(group.index, group["Código"], group["Empresa"],
+                                                                 group["Fornecedor"], group["Data Vencimento"]):
+            option_str = (f"Código da conta: {codigo} | Empresa: {empresa.title()} | "
+                          f"Fornecedor: {fornecedor.title()} | Data Vencimento: {vencimento}")
             options[option_str] = idx
         chosen_option = st.selectbox(f"Selecione a conta correta para o comprovante {code}:", list(options.keys()), key=f"amb_{code}")
         chosen_idx = options[chosen_option]
         # Para todas as linhas do grupo que NÃO foram escolhidas, zere a coluna Cod_Comprovante
-        for idx in group.index:
-            if idx != chosen_idx:
-                df.at[idx, "Cod_Comprovante"] = ""
+        not_chosen.extend(group.index[group.index != chosen_idx])
+    df.loc[not_chosen, "Cod_Comprovante"] = ""
     return df
 
 # --- FLUXO PRINCIPAL DO APP ---
@@ -155,92 +349,93 @@ uploaded_files = st.file_uploader("Selecione um ou mais arquivos PDF", type="pdf
 
 all_transactions = []
 all_summary_data = []
+file_keys = []
 
 if uploaded_files:
     for uploaded_file in uploaded_files:
         st.write(f"Processando: {uploaded_file.name} ...")
-        pdf_document = fitz.open(stream=uploaded_file.read(), filetype="pdf")
-        transactions, summary_data = extract_transactions(pdf_document)
+        # getvalue devolve os bytes do upload sem copiá-los, e o fitz também os abre sem cópia
+        file_bytes = uploaded_file.getvalue()
+        # Hash calculado uma única vez e usado como chave dos caches
+        file_key = _hash_buffer(file_bytes)
+        transactions, summary_data = parse_pdf(file_key, file_bytes)
         if transactions:
             st.success(f"{len(transactions)} comprovante(s) encontrados em {uploaded_file.name}.")
-            all_transactions.append((pdf_document, transactions))
+            all_transactions.append((file_bytes, transactions))
             all_summary_data.extend(summary_data)
+            file_keys.append(file_key)
         else:
             st.warning(f"Nenhum comprovante encontrado em {uploaded_file.name}.")
 
 if all_summary_data:
-    # DataFrame dos comprovantes extraídos
-    df_comprovantes = pd.DataFrame(all_summary_data)
+    # DataFrame dos comprovantes extraídos e sua versão padronizada, em cache pelos hashes dos PDFs
+    df_comprovantes, df_comprovantes_std, csv_comprovantes = build_comprovantes(tuple(file_keys), all_summary_data)
     st.subheader("Resumo dos Comprovantes Bancários")
     st.dataframe(df_comprovantes)
-    csv_comprovantes = df_comprovantes.to_csv(index=False, sep=";").encode()
     st.download_button("Baixar Resumo dos Comprovantes (CSV)",
                        data=csv_comprovantes,
                        file_name="resumo_comprovantes.csv",
                        mime="text/csv",
                        key="download_csv_comprovantes")
     
-    # Versão padronizada dos comprovantes
-    df_comprovantes_std = df_comprovantes.copy()
-    df_comprovantes_std = standardize_data(df_comprovantes_std, ["Empresa", "Fornecedor"])
-    df_comprovantes_std["Valor_std"] = df_comprovantes_std["Valor"].round(2)
-    
     # 2. Upload da planilha de contas a pagar
     st.subheader("Upload da Planilha de Contas a Pagar")
     contas_file = st.file_uploader("Selecione o arquivo CSV da planilha de Contas a Pagar", type="csv", key="contas")
     
     if contas_file:
-        df_contas = pd.read_csv(contas_file, sep=",", dtype=str)
-        required_cols = ["Empresa", "Fornecedor", "Data Vencimento", "Valor", "Código"]
-        if not all(col in df_contas.columns for col in required_cols):
+        contas_bytes = contas_file.getvalue()
+        contas_key = _hash_buffer(contas_bytes)
+        df_contas_std = parse_contas(contas_key, contas_bytes)
+        if df_contas_std is None:
             st.error("A planilha de contas a pagar deve conter as colunas: Empresa, Fornecedor, Data Vencimento, Valor e Código.")
         else:
-            df_contas_std = df_contas.copy()
-            df_contas_std = standardize_data(df_contas_std, ["Empresa", "Fornecedor"])
-            df_contas_std["Código"] = df_contas_std["Código"].astype(str).str.strip()
-            df_contas_std["Valor"] = df_contas_std["Valor"].str.replace(r"r\$\s*", "", regex=True).str.replace(",", ".").astype(float)
-            df_contas_std["Valor_std"] = df_contas_std["Valor"].round(2)
-            df_contas_std["Data Vencimento"] = pd.to_datetime(df_contas_std["Data Vencimento"], dayfirst=True, errors="coerce")
+            # Valores que não puderam ser convertidos (ex.: "1.234,56" ou célula vazia) viram NaN e não são conciliados
+            valor_invalido = df_contas_std["Valor"].isna()
+            if valor_invalido.any():
+                codigos = df_contas_std.loc[valor_invalido, "Código"].fillna("(sem código)").astype(str).tolist()
+                codigos_invalidos = ", ".join(codigos[:10]) + (f" e mais {len(codigos) - 10}" if len(codigos) > 10 else "")
+                st.warning(f"{len(codigos)} conta(s) com Valor inválido não serão conciliadas. "
+                           f"Códigos: {codigos_invalidos}")
             st.subheader("Resumo da Planilha de Contas a Pagar")
             st.dataframe(df_contas_std)
+            # Empresa e Fornecedor com as mesmas categorias nos dois lados, para merges e comparações por código
+            df_contas_std, df_comprovantes_std = prepare_for_matching(tuple(file_keys), contas_key,
+                                                                      df_contas_std, df_comprovantes_std)
             
             # 3. Seleção do método de correspondência
-            match_method = st.selectbox("Selecione o método de correspondência:", options=["Padrão", "Fuzzy Wuzzy", "RapidFuzz"])
+            match_method = st.selectbox("Selecione o método de correspondência:", options=["Padrão", "Fuzzy (RapidFuzz)"])
             if match_method == "Padrão":
                 df_conciliado = pd.merge(
                     df_contas_std,
                     df_comprovantes_std,
-                    left_on=["Empresa", "Fornecedor", "Valor_std"],
-                    right_on=["Empresa", "Fornecedor", "Valor_std"],
+                    left_on=["Empresa", "Fornecedor", "Valor_cents"],
+                    right_on=["Empresa", "Fornecedor", "Valor_cents"],
                     how="left",
                     suffixes=("_conta", "_comprovante")
                 )
             else:
                 threshold = st.slider("Defina o limiar para correspondência fuzzy:", min_value=50, max_value=100, value=90)
-                if match_method == "Fuzzy Wuzzy":
-                    df_conciliado = fuzzy_merge(df_contas_std, df_comprovantes_std, method="fuzzywuzzy", threshold=threshold)
-                elif match_method == "RapidFuzz":
-                    df_conciliado = fuzzy_merge(df_contas_std, df_comprovantes_std, method="rapidfuzz", threshold=threshold)
+                df_conciliado = fuzzy_merge(tuple(file_keys), contas_key, df_contas_std, df_comprovantes_std,
+                                            threshold=threshold)
             
             # Converter "Data da Operação" para datetime (se aplicável)
             df_conciliado["Data da Operação"] = pd.to_datetime(df_conciliado["Data da Operação"], dayfirst=True, errors="coerce")
-            df_conciliado["Data_Match"] = df_conciliado.apply(
-                lambda row: row["Data Vencimento"] == row["Data da Operação"]
-                if pd.notnull(row["Data Vencimento"]) and pd.notnull(row["Data da Operação"]) else False, axis=1
-            )
+            data_vencimento = df_conciliado["Data Vencimento"]
+            data_operacao = df_conciliado["Data da Operação"]
+            df_conciliado["Data_Match"] = data_vencimento.notna() & data_operacao.notna() & (data_vencimento == data_operacao)
             
             # 4. Na conciliação inicial, crie a coluna "Possível_Cod_Comprovante"
             # Essa coluna será igual a "Número do Documento" (pode haver duplicidade)
-            df_conciliado["Possível_Cod_Comprovante"] = df_conciliado["Número do Documento"]
-            # Crie também a coluna "Cod_Comprovante", que inicialmente recebe o mesmo valor
-            df_conciliado["Cod_Comprovante"] = df_conciliado["Possível_Cod_Comprovante"]
+            # e "Cod_Comprovante" inicialmente recebe o mesmo valor
+            df_conciliado = df_conciliado.assign(Possível_Cod_Comprovante=df_conciliado["Número do Documento"],
+                                                 Cod_Comprovante=df_conciliado["Número do Documento"])
             
             # Se houver ambiguidade (ou seja, o mesmo comprovante para mais de uma conta), resolva:
             if df_conciliado["Possível_Cod_Comprovante"].dropna().duplicated().any():
                 st.write("Foram detectadas ambiguidades na vinculação dos comprovantes. Por favor, resolva:")
                 df_conciliado_final = resolve_ambiguous_receipts(df_conciliado)
             else:
-                df_conciliado_final = df_conciliado.copy()
+                df_conciliado_final = df_conciliado
             
             st.subheader("Tabela de Conciliação Final")
             st.dataframe(df_conciliado_final)
@@ -252,10 +447,9 @@ if all_summary_data:
                                key="download_conciliado_final")
             
             # 5. Contas a Pagar sem Conciliação: linhas em que "Cod_Comprovante" está vazio
-            df_contas_sem = df_conciliado_final[
-                df_conciliado_final["Cod_Comprovante"].isna() |
-                (df_conciliado_final["Cod_Comprovante"].astype(str).str.strip() == "")
-            ]
+            # (nulo sem correspondência ou "" quando não escolhida na ambiguidade; os códigos são só dígitos)
+            cod_comprovante = df_conciliado_final["Cod_Comprovante"]
+            df_contas_sem = df_conciliado_final[cod_comprovante.isna() | (cod_comprovante == "")]
             st.subheader("Contas a Pagar sem Conciliação")
             if df_contas_sem.empty:
                 st.warning("🚨 Nenhuma conta a pagar sem conciliação encontrada.")
@@ -283,11 +477,16 @@ if all_summary_data:
 # 7. Download dos PDFs individuais dos comprovantes
 if all_transactions:
     st.subheader("Download dos Comprovantes Individuais (PDF)")
+    st.download_button("Baixar Todos os Comprovantes (ZIP)",
+                       data=lambda: save_transaction_pdfs_zip(all_transactions),
+                       file_name="comprovantes.zip",
+                       mime="application/zip",
+                       key="download_pdfs_zip")
     pdf_index = 0
-    for pdf_document, transactions in all_transactions:
-        for file_name, pdf_bytes in save_transaction_pdfs(pdf_document, transactions):
+    for file_bytes, transactions in all_transactions:
+        for page_num, file_name in transactions:
             st.download_button(label=f"Baixar {file_name}",
-                               data=pdf_bytes,
+                               data=lambda pdf_bytes=file_bytes, page_num=page_num: _make_single_page_pdf(pdf_bytes, page_num),
                                file_name=file_name,
                                mime="application/pdf",
                                key=f"download_pdf_{pdf_index}")